@@ -3,7 +3,8 @@
 """
 import json
 from datetime import datetime
-from math import log2
+
+import numpy as np
 
 from heatmap import HeatMap, DefaultRenderer
 from heatmap.extractors import MVGExtractor, GoogleBike
@@ -13,8 +14,8 @@ google_key = 'YOUR GOOGLE KEY'
 
 home = (48.128446, 11.650027)
 
-mvg = MVGExtractor(mvg_key)
-bike = GoogleBike(google_key)
+mvg = MVGExtractor(mvg_key, num_threads=100, cache_name='mvg_cache')
+bike = GoogleBike(google_key, num_threads=100, cache_name='google_cache')
 
 
 def calc_time(pt1, pt2):
@@ -42,10 +43,9 @@ with open('./geo/muenchen.json', 'r') as fp:
     geo_json = json.load(fp)
 
 
-def normalize_log2_scale(val, _1, _2):
-    if val > 0:
-        return 0.5 + log2(val) / 3
-    return 0.5 - log2(abs(val)) / 2
+def normalize_log2_scale(vals, _1, _2):
+    log_vals = np.log2(np.abs(vals))
+    return np.where(vals > 0, 0.5 + log_vals / 3, 0.5 - log_vals / 2)
 
 
 def make_label(obj):
@@ -79,6 +79,6 @@ renderer = DefaultRenderer(center=home, zoom=12, opacity=0.5, label=make_label,
 h_map = HeatMap(home, geo_json, filename='bike_vs_ubahn', square_size=800, num_threads=100,
                 load_intermediate_results=True)
 h_map.generate(calc_time)
-h_map.normalize(normalize_log2_scale)
+h_map.normalize(normalize_log2_scale, vectorized=True)
 h_map.generate_polygon(bikable_zone, color='#0012b3', opacity=0.6, weight=5, dash_array=[1, 6])
 h_map.render(renderer, before_saving=lambda r, _: r.add_circle(home, color='#0012b3', radius=20))
@@ -5,16 +5,49 @@ It will plot a custom heatmap showing the distances from any point in Munich to
 Public toilets will be marked as small circles on the map, and a region will be drawn representing areas
 that are 1km or closer to public toilets.
 """
+import hashlib
 import json
-from math import sqrt, e as euler_num
+import os
+from math import e as euler_num
 
-from geopy.distance import distance
+import numpy as np
+from numba import njit, prange
+from scipy.spatial import cKDTree
 
 from heatmap import HeatMap, DefaultRenderer
 from heatmap.extractors import CSVExtractor
 
 marienplatz = (48.1373629, 11.5748808)
 inv_euler = (1.0 / euler_num)
+earth_radius_km = 6371.0088
+
+
+@njit(fastmath=True, cache=True)
+def _toilet_kernel(point_lat, point_lon, cand_lats, cand_lons):
+    """
+    Compiled haversine distance from a point to its closest candidate, and the log-scaled value for it.
+    All coordinates in radians, distance in km.
+    """
+    min_dist = np.inf
+    for i in range(cand_lats.shape[0]):
+        a = (np.sin((cand_lats[i] - point_lat) / 2.0) ** 2 +
+             np.cos(point_lat) * np.cos(cand_lats[i]) * np.sin((cand_lons[i] - point_lon) / 2.0) ** 2)
+        dist = 2.0 * earth_radius_km * np.arcsin(np.sqrt(a))
+        if dist < min_dist:
+            min_dist = dist
+    return min_dist, min_dist ** inv_euler
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _batch_toilet(pts_lat, pts_lon, cand_lats, cand_lons):
+    """
+    _toilet_kernel over many points in parallel. Candidates are given as (N, k) arrays, one row per point.
+    Returns the distances to the closest toilet, in km.
+    """
+    out_min = np.empty(pts_lat.shape[0])
+    for i in prange(pts_lat.shape[0]):
+        out_min[i] = _toilet_kernel(pts_lat[i], pts_lon[i], cand_lats[i], cand_lons[i])[0]
+    return out_min
 
 
 def custom_color_scale(value):
@@ -28,37 +61,70 @@ def custom_color_scale(value):
 
 class ToiletExtractor(CSVExtractor):
     delimiter = '\t'
-
-    @staticmethod
-    def _euclidian_distance(p1, p2):
-        """ Calculates the euclidian distance between two points """
-        return sqrt((p2[0] - p1[0]) ** 2 + (p2[1] - p1[1]) ** 2)
+    num_candidates = 15
+
+    def __init__(self, *args, filename=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Where to keep the closest toilets to each grid point between runs
+        self.neighbors_file_name = f'{filename}.neighbors.npz' if filename else None
+        # Toilet coordinates in radians, leaving out the ones without a location
+        self._coords = np.column_stack((self.lat_rad, self.lon_rad))[self.has_loc]
+        self._tree = cKDTree(self._coords)
+        # Compile the kernel now, instead of on the first grid square
+        _toilet_kernel(0.0, 0.0, self._coords[:1, 0].copy(), self._coords[:1, 1].copy())
 
     def get_value(self, _, point):
         """
         Returns the distance between a point and the closes public toilet
         """
         # Because it is so much cheaper the calculate, and for such a small distance not all that different,
-        # first we get the 15-closest toilets by using euclidian distance
-        by_euclidian_dist = {i: self._euclidian_distance(self.get_loc(p), point) for i, p in enumerate(self.data)}
-        closest = sorted(by_euclidian_dist.items(), key=lambda v: v[1])[0:15]
-        min_dist = None
-        # Then we iterate over this 15 to get the actual geodesic distance
-        for idx, _ in closest:
-            toilet_dist = distance().measure(self.get_loc(self.data[idx]), point)
-            min_dist = min(min_dist or toilet_dist, toilet_dist)
+        # first we get the 15-closest toilets by querying a kd-tree with euclidian distance
+        point = np.radians(point)
+        k = min(self.num_candidates, len(self._coords))
+        _, idxs = self._tree.query(point, k=k)
+        # Then we get the actual great-circle distance to this 15, on a compiled kernel
+        candidates = self._coords[np.atleast_1d(idxs)]
+        min_dist, value = _toilet_kernel(float(point[0]), float(point[1]),
+                                         np.ascontiguousarray(candidates[:, 0]),
+                                         np.ascontiguousarray(candidates[:, 1]))
 
         # We want the distance in log scale
+        return {'value': value, 'lin_value': min_dist}
+
+    def get_values_batched(self, _, points):
+        """
+        Same as get_value, but for an array of points of shape (N, 2) at once
+        """
+        points = np.radians(points)
+        _, candidates = self._neighbors(points)
+        min_dist = _batch_toilet(np.ascontiguousarray(points[:, 0]), np.ascontiguousarray(points[:, 1]),
+                                 np.ascontiguousarray(candidates[..., 0]), np.ascontiguousarray(candidates[..., 1]))
         return {'value': min_dist ** inv_euler, 'lin_value': min_dist}
 
+    def _neighbors(self, points):
+        """
+        Indices and coordinates of the 15-closest toilets to each point, for an (N, 2) array of points in radians.
+        Cached on disk if a file name was given.
+        """
+        k = min(self.num_candidates, len(self._coords))
+        key = hashlib.sha1(b'%d' % k + self._coords.tobytes() + points.tobytes()).hexdigest()
+        if self.neighbors_file_name and os.path.isfile(self.neighbors_file_name):
+            with np.load(self.neighbors_file_name) as cached:
+                if str(cached['key']) == key:
+                    return cached['idxs'], cached['candidates']
+
+        _, idxs = self._tree.query(points, k=k)
+        idxs = idxs.reshape(len(points), k)
+        candidates = self._coords[idxs]
+        if self.neighbors_file_name:
+            np.savez(self.neighbors_file_name, key=key, idxs=idxs, candidates=candidates)
+        return idxs, candidates
+
     def add_markers(self, rend: DefaultRenderer, _):
         """ Add circles around public toilets """
-        for toilet in self.data:
-            toilet_loc = self.get_loc(toilet)
-            if not toilet_loc:
-                continue
-            rend.add_circle(toilet_loc,
-                            label=self.get_label(toilet),
+        for idx in np.flatnonzero(self.has_loc):
+            rend.add_circle(self.get_loc(idx),
+                            label=self.get_label(self.get_row(idx)),
                             radius=10,
                             fill_color='#0ef',
                             fill_opacity=1,
@@ -79,7 +145,8 @@ with open('./geo/muenchen.json', 'r') as fp:
     geo_json = json.load(fp)
 
 # The extractor gets the data
-toilet_extr = ToiletExtractor('./data/oeffentlichetoilettenmuenchen2016-06-28.csv', 'latitude', 'longitude')
+toilet_extr = ToiletExtractor('./data/oeffentlichetoilettenmuenchen2016-06-28.csv', 'latitude', 'longitude',
+                              filename='toilet')
 
 # The renderer deals with visual aspects of the map
 renderer = DefaultRenderer(center=marienplatz,
@@ -90,7 +157,7 @@ renderer = DefaultRenderer(center=marienplatz,
 
 # Create a new heatmap
 h_map = HeatMap(None, geo_json, filename='toilet', square_size=500, num_threads=100, load_intermediate_results=True)
-h_map.generate(toilet_extr.get_value)
+h_map.generate_batched(toilet_extr)
 h_map.normalize()
 # Generate the polygon areas within 1km of a public toilet
 h_map.generate_polygon(lambda v: v.get('lin_value', 999) < 1.0, dash_array=[5, 5], color='#0ef', opacity=0.5, weight=2)
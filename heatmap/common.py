@@ -1,3 +1,8 @@
 from typing import Tuple
 
+import shapely
+
 Coord = Tuple[float, float]
+
+# Shapely 2 returns indices from STRtree queries and adds vectorized functions over arrays of geometries
+SHAPELY_2 = int(shapely.__version__.split('.')[0]) >= 2
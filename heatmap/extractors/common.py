@@ -0,0 +1,35 @@
+from typing import Optional
+
+import aiohttp
+import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+
+# How long cached responses are kept, in seconds
+CACHE_EXPIRE_AFTER = 7 * 24 * 60 * 60
+
+
+def make_session(num_threads: int, cache_name: Optional[str] = None) -> requests.Session:
+    """
+    Create a session that keeps connections alive between requests
+    :param num_threads: number of threads that will share the session
+    :param cache_name: if given, responses are cached on a sqlite database with this name
+    :return: the session
+    """
+    if cache_name:
+        session = requests_cache.CachedSession(cache_name=cache_name,
+                                               backend='sqlite',
+                                               expire_after=CACHE_EXPIRE_AFTER)
+    else:
+        session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=num_threads, pool_maxsize=num_threads))
+    return session
+
+
+def make_async_session(num_threads: int) -> aiohttp.ClientSession:
+    """
+    Create an asyncio session that keeps connections alive between requests. Must be called from a coroutine.
+    :param num_threads: maximum number of concurrent connections
+    :return: the session
+    """
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=num_threads))
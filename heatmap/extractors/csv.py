@@ -1,6 +1,8 @@
-import csv
 from abc import ABC, abstractmethod
-from typing import TextIO, List
+from typing import TextIO, Optional
+
+import numpy as np
+import pandas as pd
 
 from heatmap.common import Coord
 
@@ -21,18 +23,28 @@ class CSVExtractor(ABC):
         self.lon_key = lon_key
         with open(file_path, 'r') as csv_file:
             self.data = load_csv(csv_file, self.delimiter)
+        # Coordinates of every row in radians, NaN where the row has none
+        self.lat_rad = np.deg2rad(_float_column(self.data[lat_key]))
+        self.lon_rad = np.deg2rad(_float_column(self.data[lon_key]))
+        self.has_loc = ~(np.isnan(self.lat_rad) | np.isnan(self.lon_rad))
 
-    def get_loc(self, item: dict) -> Coord:
+    def get_loc(self, idx: int) -> Optional[Coord]:
         """
         Get the location of one row
-        :param item: The dict representing a row on the CSV
-        :return: The coordinates as a tuple of 2 floats
+        :param idx: The index of the row on the CSV
+        :return: The coordinates in degrees as a tuple of 2 floats, or None if the row has no location
         """
-        lat = item.get(self.lat_key)
-        lon = item.get(self.lon_key)
-        if not lat or not lon:
+        if not self.has_loc[idx]:
             return None
-        return float(lat), float(lon)
+        return float(np.rad2deg(self.lat_rad[idx])), float(np.rad2deg(self.lon_rad[idx]))
+
+    def get_row(self, idx: int) -> dict:
+        """
+        Get one row of the CSV
+        :param idx: The index of the row on the CSV
+        :return: The row as a dict of column name to (string) value
+        """
+        return self.data.iloc[idx].to_dict()
 
     @abstractmethod
     def get_value(self, origin: Coord, point: Coord) -> float:
@@ -45,25 +57,21 @@ class CSVExtractor(ABC):
         raise NotImplementedError()
 
 
-def load_csv(stream: TextIO, delimiter: str) -> List[dict]:
+def _float_column(column: pd.Series) -> np.ndarray:
+    """
+    Convert one column of the CSV to an array of floats.
+    :param column: the column, as loaded by load_csv
+    :return: the column values, NaN where empty
+    """
+    return pd.to_numeric(column, errors='coerce').to_numpy(dtype=np.float64)
+
+
+def load_csv(stream: TextIO, delimiter: str) -> pd.DataFrame:
     """
-    Loads a CSV into a list of dictionaries.
-    First row representing the key names
+    Loads a CSV into a data frame of strings.
+    First row representing the column names. Empty cells are kept as empty strings.
     :param stream: file IO
     :param delimiter: CSV delimiter
-    :return: the contents as a list of dicts.
+    :return: the contents as a data frame.
     """
-    columns = []
-    first_row = True
-    data = list()
-    csv_reader = csv.reader(stream, delimiter=delimiter)
-    for row in csv_reader:
-        if first_row:
-            columns = row
-            first_row = False
-        else:
-            entry = dict()
-            for idx, value in enumerate(row):
-                entry[columns[idx]] = value
-            data.append(entry)
-    return data
+    return pd.read_csv(stream, sep=delimiter, dtype=str, keep_default_na=False)
@@ -1,19 +1,30 @@
+import json
+from typing import Optional
 from urllib.parse import urlencode
 
 import requests
 
 from heatmap.common import Coord
+from heatmap.extractors.common import make_session, make_async_session
 
 
 class GoogleBike(object):
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, num_threads: int = 10, cache_name: Optional[str] = None):
         """
         Uses Google's Distance Matrix API to retrieve the travel time between two points.
         WARNING! The API is not free, and you will be charged for its use.
         :param api_key: Your key for the api
+        :param num_threads: number of threads (or coroutines, with the async methods) that will make requests
+                            concurrently, to size the connection pool
+        :param cache_name: if given, responses are cached for a week on a sqlite database with this name, so
+                           that re-running the same heatmap does not query the API again. The async methods
+                           do not use the cache.
         """
         self._key = api_key
         self._base_uri = 'https://maps.googleapis.com/maps/api/distancematrix/json'
+        self._num_threads = num_threads
+        self._session = make_session(num_threads, cache_name)
+        self._async_session = None
 
     def average_time_between(self, from_pt: Coord, to_pt: Coord) -> float:
         """
@@ -24,12 +35,31 @@ class GoogleBike(object):
         :return: a float representing the time in seconds
         """
         uri = self._get_uri(from_pt, to_pt)
-        res = requests.get(uri)
+        res = self._session.get(uri)
         data = _get_rest_json(res)
-        row = data['rows'][0]['elements'][0]
-        duration_s = row.get('duration', {}).get('value', None)
+        return _duration(data)
 
-        return duration_s
+    async def average_time_between_async(self, from_pt: Coord, to_pt: Coord) -> float:
+        """
+        Same as average_time_between, but as a coroutine. Call close_async once done with it.
+        :param from_pt: origin coordinate
+        :param to_pt: destination coordinate
+        :raises ValueError: If the response body does not contain valid json.
+        :return: a float representing the time in seconds
+        """
+        if self._async_session is None:
+            self._async_session = make_async_session(self._num_threads)
+        async with self._async_session.get(self._get_uri(from_pt, to_pt)) as res:
+            data = _parse_rest_json(res.status, await res.text())
+        return _duration(data)
+
+    async def close_async(self) -> None:
+        """
+        Close the connections opened by the async methods
+        """
+        if self._async_session is not None:
+            await self._async_session.close()
+            self._async_session = None
 
     def _get_uri(self, from_pt: Coord, to_pt: Coord) -> str:
         """
@@ -48,9 +78,19 @@ class GoogleBike(object):
         return f'{self._base_uri}?{query_strings}'
 
 
-def _json_decode_failed(res):
+def _json_decode_failed(status_code: int, text: str):
     """ Simply raises a decoding error """
-    raise ValueError(f'Got something weird ({res.status_code}): \n {res.text}')
+    raise ValueError(f'Got something weird ({status_code}): \n {text}')
+
+
+def _duration(data: dict) -> Optional[float]:
+    """
+    Extract the travel time from the API's response
+    :param data: json data
+    :return: the time in seconds, or None if there is none
+    """
+    row = data['rows'][0]['elements'][0]
+    return row.get('duration', {}).get('value', None)
 
 
 def _coords_to_str(lat: float, lon: float) -> str:
@@ -73,12 +113,23 @@ def _get_rest_json(res: requests.Response):
     :raises ValueError: If the response body does not contain valid json.
     :return: json data
     """
-    if res.status_code != 200:
-        return _json_decode_failed(res)
+    return _parse_rest_json(res.status_code, res.text)
+
+
+def _parse_rest_json(status_code: int, text: str):
+    """
+    Decodes the json body of a response or throws an error.
+    :param status_code: the HTTP status of the response
+    :param text: the body of the response
+    :raises ValueError: If the response body does not contain valid json.
+    :return: json data
+    """
+    if status_code != 200:
+        return _json_decode_failed(status_code, text)
     try:
-        data = res.json()
+        data = json.loads(text)
     except ValueError:
-        return _json_decode_failed(res)
+        return _json_decode_failed(status_code, text)
     if data.get('status').lower() != 'ok':
-        return _json_decode_failed(res)
+        return _json_decode_failed(status_code, text)
     return data
@@ -1,24 +1,31 @@
 import time
-from copy import deepcopy
 from datetime import datetime
 from json.decoder import JSONDecodeError
 from typing import Optional, Any
 from urllib.parse import urlencode
 
-import requests
-
 from heatmap.common import Coord
+from heatmap.extractors.common import make_session, make_async_session
 
 
 class MVGExtractor(object):
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, num_threads: int = 10, cache_name: Optional[str] = None):
         """
         Extracts distance data from the MVG (Munich's subway operator) API.
 
         :param api_key: The MVG API key
+        :param num_threads: number of threads (or coroutines, with the async methods) that will make requests
+                            concurrently, to size the connection pool
+        :param cache_name: if given, responses are cached for a week on a sqlite database with this name, so
+                           that re-running the same heatmap does not query the API again. The async methods
+                           do not use the cache.
         """
         self._key = api_key
         self._base_uri = 'https://apps.mvg-fahrinfo.de/v12/rest/12.0'
+        self._num_threads = num_threads
+        self._session = make_session(num_threads, cache_name)
+        self._bucket_ref_times = cache_name is not None
+        self._async_session = None
 
     def get_route_custom(self, ref_time: Optional[float] = None, **opts) -> dict:
         """
@@ -27,12 +34,7 @@ class MVGExtractor(object):
         :param opts: Extra options
         :return: Route info as a dict
         """
-        url_args = {
-            **_route_request_defaults,
-            **opts,
-            'time': int(time.time() * 1000) or ref_time,
-        }
-        return self._make_request('routing/', url_args)
+        return self._make_request('routing/', _route_url_args(ref_time, opts))
 
     def get_route_from_coords(self, from_pt: Coord, to_pt: Coord, ref_time: Optional[float] = None, **opts) -> dict:
         """
@@ -43,12 +45,7 @@ class MVGExtractor(object):
         :param opts: Extra options
         :return: Route info as a dict
         """
-        return self.get_route_custom(ref_time=ref_time,
-                                     fromLatitude=from_pt[0],
-                                     fromLongitude=from_pt[1],
-                                     toLatitude=to_pt[0],
-                                     toLongitude=to_pt[1],
-                                     **opts)
+        return self.get_route_custom(ref_time=ref_time, **_coords_url_args(from_pt, to_pt), **opts)
 
     def average_time_between(self, from_pt: Coord, to_pt: Coord, ref_date: datetime, **opts) -> Optional[float]:
         """
@@ -56,20 +53,49 @@ class MVGExtractor(object):
 
         :param from_pt: origin coordinates
         :param to_pt: destination coordinates
-        :param ref_date: Reference date-time for the query.
+        :param ref_date: Reference date-time for the query. Rounded to the nearest half hour if responses are cached.
         :param opts: extra options
         :return: The average travel time in seconds, or None if no route was found.
         """
-        ref_time = int(ref_date.timestamp() * 1000)
-        route = self.get_route_from_coords(from_pt, to_pt, ref_time=ref_time, **opts)
-        times = []
-        for conn in route['connectionList']:
-            duration_min = (conn['arrival'] - conn['departure']) / 1000.0
-            times.append(duration_min)
-        three_shortest = sorted(times)[0:3]
-        if not three_shortest:
-            return None
-        return sum(three_shortest) / len(three_shortest)
+        route = self.get_route_from_coords(from_pt, to_pt, ref_time=self._ref_time(ref_date), **opts)
+        return _average_route_time(route)
+
+    async def average_time_between_async(self,
+                                         from_pt: Coord,
+                                         to_pt: Coord,
+                                         ref_date: datetime,
+                                         **opts) -> Optional[float]:
+        """
+        Same as average_time_between, but as a coroutine. Call close_async once done with it.
+
+        :param from_pt: origin coordinates
+        :param to_pt: destination coordinates
+        :param ref_date: Reference date-time for the query. Not rounded, since the async methods have no cache.
+        :param opts: extra options
+        :return: The average travel time in seconds, or None if no route was found.
+        """
+        url_args = _route_url_args(int(ref_date.timestamp() * 1000), {**_coords_url_args(from_pt, to_pt), **opts})
+        route = await self._make_request_async('routing/', url_args)
+        return _average_route_time(route)
+
+    async def close_async(self) -> None:
+        """
+        Close the connections opened by the async methods
+        """
+        if self._async_session is not None:
+            await self._async_session.close()
+            self._async_session = None
+
+    def _ref_time(self, ref_date: datetime) -> int:
+        """
+        Timestamp in ms to query for a reference date-time. With a cache, it is rounded so that queries for about
+        the same time share cached responses
+        :param ref_date: the date-time
+        :return: the timestamp
+        """
+        if self._bucket_ref_times:
+            return _bucket_ref_time(ref_date)
+        return int(ref_date.timestamp() * 1000)
 
     def _make_request(self, path: str, url_args: Optional[dict] = None, method: str = 'get'):
         """
@@ -80,28 +106,116 @@ class MVGExtractor(object):
         :param method: HTTP method
         :return: json response
         """
-        req_method = getattr(requests, method)
+        req_method = getattr(self._session, method)
+        res = req_method(self._get_uri(path, url_args, method), headers=_request_headers)
+        try:
+            return res.json()
+        except JSONDecodeError:
+            return None
 
-        url_args = deepcopy(url_args or {})
+    async def _make_request_async(self, path: str, url_args: Optional[dict] = None, method: str = 'get'):
+        """
+        Makes a request to the API without blocking the event loop
+
+        :param path: endpoint path
+        :param url_args: URL query strings
+        :param method: HTTP method
+        :return: json response
+        """
+        if self._async_session is None:
+            self._async_session = make_async_session(self._num_threads)
+        uri = self._get_uri(path, url_args, method)
+        async with self._async_session.request(method.upper(), uri, headers=_request_headers) as res:
+            try:
+                return await res.json(content_type=None)
+            except JSONDecodeError:
+                return None
+
+    def _get_uri(self, path: str, url_args: Optional[dict], method: str) -> str:
+        """
+        Make the URI for a request to the API
+
+        :param path: endpoint path
+        :param url_args: URL query strings
+        :param method: HTTP method
+        :return: the URI
+        """
+        url_args = url_args or {}
 
         if method == 'get':
-            url_args['apiKey'] = self._key
+            url_args = {**url_args, 'apiKey': self._key}
 
         if url_args:
-            args = urlencode({k: _coerce_to_string(v) for k, v in (url_args or {}).items()})
+            args = urlencode([(k, v if type(v) is str else _coerce_to_string(v)) for k, v in url_args.items()])
             args = f'?{args}'
         else:
             args = ''
-        uri = f'{self._base_uri.rstrip("/")}/{path.lstrip("/")}{args}'
-        headers = {
-            'User-Agent': 'MVG Fahrinfo Android 5.10',
-            'Host': 'apps.mvg-fahrinfo.de',
-        }
-        res = req_method(uri, headers=headers)
-        try:
-            return res.json()
-        except JSONDecodeError:
-            return None
+        return f'{self._base_uri.rstrip("/")}/{path.lstrip("/")}{args}'
+
+
+def _route_url_args(ref_time: Optional[float], opts: dict) -> dict:
+    """
+    URL query strings for a route request
+    :param ref_time: Reference timestamp for the query. None for 'now'
+    :param opts: Extra options
+    :return: the query strings
+    """
+    return {
+        **_route_request_defaults,
+        **opts,
+        'time': ref_time if ref_time is not None else int(time.time() * 1000),
+    }
+
+
+def _coords_url_args(from_pt: Coord, to_pt: Coord) -> dict:
+    """
+    URL query strings for the origin and destination of a route request
+    :param from_pt: origin coordinates
+    :param to_pt: destination coordinates
+    :return: the query strings
+    """
+    return {
+        'fromLatitude': from_pt[0],
+        'fromLongitude': from_pt[1],
+        'toLatitude': to_pt[0],
+        'toLongitude': to_pt[1],
+    }
+
+
+def _bucket_ref_time(ref_date: datetime) -> int:
+    """
+    Timestamp in ms of a reference date-time, rounded to the nearest half hour so that queries for
+    about the same time share cached responses
+    :param ref_date: the date-time
+    :return: the timestamp
+    """
+    return int(round(ref_date.timestamp() / _ref_time_bucket_s) * _ref_time_bucket_s * 1000)
+
+
+def _average_route_time(route: dict) -> Optional[float]:
+    """
+    Average duration of the 3-fastest connections of a route response
+    :param route: the route info
+    :return: The average travel time in seconds, or None if no route was found.
+    """
+    times = []
+    for conn in route['connectionList']:
+        duration_min = (conn['arrival'] - conn['departure']) / 1000.0
+        times.append(duration_min)
+    three_shortest = sorted(times)[0:3]
+    if not three_shortest:
+        return None
+    return sum(three_shortest) / len(three_shortest)
+
+
+_TRUE = 'true'
+_FALSE = 'false'
+
+# How to turn each type of value into a string for the request's URI. Anything else goes through str()
+_coercers = {
+    bool: lambda value: _TRUE if value else _FALSE,
+    float: lambda value: '%.5f' % value,
+}
 
 
 def _coerce_to_string(value: Any) -> str:
@@ -110,37 +224,44 @@ def _coerce_to_string(value: Any) -> str:
     :param value: anything
     :return: a string
     """
-    if value is True:
-        return 'true'
-    if value is False:
-        return 'false'
-    if isinstance(value, float):
-        return '%.5f' % value
-    return str(value)
+    coercer = _coercers.get(type(value))
+    if coercer is None:
+        # Subclasses, like numpy's scalars, are coerced like their base type
+        coercer = next((c for base, c in _coercers.items() if isinstance(value, base)), str)
+    return coercer(value)
 
 
-# Default parameters for the route request
+# Headers sent on every request
+_request_headers = {
+    'User-Agent': 'MVG Fahrinfo Android 5.10',
+    'Host': 'apps.mvg-fahrinfo.de',
+}
+
+# Default parameters for the route request, already as they go on the URI
 _route_request_defaults = {
     'language': 'en',
-    'transportTypeBus': True,
-    'transportTypeTrain': True,
-    'transportTypeCable': True,
-    'transportTypeBoat': True,
-    'transportTypeTram': True,
-    'transportTypeSBahn': True,
-    'transportTypeUnderground': True,
-    'maxTravelTimeFootwayToStation': 10,
-    'maxTravelTimeFootwayToDestination': 10,
-    'arrival': False,
-    'lowfloorVehicles': False,
-    'showZoom': False,
+    'transportTypeBus': _TRUE,
+    'transportTypeTrain': _TRUE,
+    'transportTypeCable': _TRUE,
+    'transportTypeBoat': _TRUE,
+    'transportTypeTram': _TRUE,
+    'transportTypeSBahn': _TRUE,
+    'transportTypeUnderground': _TRUE,
+    'maxTravelTimeFootwayToStation': '10',
+    'maxTravelTimeFootwayToDestination': '10',
+    'arrival': _FALSE,
+    'lowfloorVehicles': _FALSE,
+    'showZoom': _FALSE,
     'walkSpeed': 'NORMAL',
-    'noEscalators': False,
-    'noSolidStairs': False,
-    'noElevators': False,
-    'lineInformation': False,
-    'wheelchair': False,
-    'changeLimit': 9,
+    'noEscalators': _FALSE,
+    'noSolidStairs': _FALSE,
+    'noElevators': _FALSE,
+    'lineInformation': _FALSE,
+    'wheelchair': _FALSE,
+    'changeLimit': '9',
 }
 
 _muenchen = 'München'
+
+# Granularity of the reference time of route requests, in seconds
+_ref_time_bucket_s = 30 * 60
@@ -0,0 +1,215 @@
+import json
+import os
+import shutil
+from abc import ABC, abstractmethod
+from typing import BinaryIO, List
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+class IntermediateStore(ABC):
+    extension = None
+
+    def __init__(self, filename: str):
+        """
+        Abstract storage for the intermediate results of a heatmap, so that processing can be resumed later.
+        Appended entries may be buffered until flush or close are called.
+        :param filename: a file name (without extension) representing the heatmap
+        """
+        self.path = f'{filename}.{self.extension}'
+
+    def exists(self) -> bool:
+        """ Whether there are stored results """
+        return os.path.exists(self.path)
+
+    @abstractmethod
+    def load(self) -> List[dict]:
+        """
+        Load all stored entries
+        :return: the entries as a list of dicts
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def reset(self) -> None:
+        """ Discard all stored entries """
+        raise NotImplementedError
+
+    @abstractmethod
+    def append(self, data: dict) -> None:
+        """
+        Store one entry
+        :param data: the entry
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def flush(self) -> None:
+        """ Persist any buffered entries """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """ Persist any buffered entries and release the underlying resources """
+        self.flush()
+
+
+class JsonlStore(IntermediateStore):
+    extension = 'jsonl'
+
+    def __init__(self, filename: str):
+        """
+        Stores intermediate results on a json lines file (http://jsonlines.org/), one entry per line.
+        """
+        super().__init__(filename)
+        self._fp = None
+
+    def load(self) -> List[dict]:
+        with open(self.path, 'rb') as fp:
+            return _parse_jsonl(fp)
+
+    def reset(self) -> None:
+        self.close()
+        open(self.path, 'w').close()
+
+    def append(self, data: dict) -> None:
+        if self._fp is None:
+            self._fp = open(self.path, 'ab', buffering=1 << 20)
+        self._fp.write(_dump_json_line(data))
+
+    def flush(self) -> None:
+        if self._fp is not None:
+            self._fp.flush()
+
+    def close(self) -> None:
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+class ParquetStore(IntermediateStore):
+    extension = 'parquet'
+
+    def __init__(self, filename: str):
+        """
+        Stores intermediate results as a directory of Parquet files, one per flush.
+        Columns are typed and compressed, instead of repeating every key on every entry. Requires pyarrow.
+        """
+        if pa is None:
+            raise ImportError('pyarrow is required to store intermediate results as Parquet')
+        super().__init__(filename)
+        self._rows = []
+        self._next_part = None
+
+    def load(self) -> List[dict]:
+        entries = []
+        for part in sorted(os.listdir(self.path)):
+            # Parts may have different columns, so they are read one by one instead of as a single dataset
+            table = pq.read_table(os.path.join(self.path, part))
+            json_columns = _json_columns(table.schema)
+            for row in table.to_pylist():
+                lacking = row.pop(_LACKING_COLUMN, None) or []
+                entries.append({k: json.loads(v) if k in json_columns else v
+                                for k, v in row.items() if k not in lacking})
+        return entries
+
+    def reset(self) -> None:
+        self._rows = []
+        self._next_part = 0
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+
+    def append(self, data: dict) -> None:
+        self._rows.append(data)
+
+    def flush(self) -> None:
+        if not self._rows:
+            return
+        rows, self._rows = self._rows, []
+        columns = {}
+        for row in rows:
+            for key in row:
+                columns.setdefault(key, None)
+        arrays, json_columns = {}, []
+        for key in columns:
+            values = [row.get(key) for row in rows]
+            try:
+                arrays[key] = pa.array(values)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # Values of different types can not share a column, so they are stored as json instead
+                arrays[key] = pa.array([json.dumps(value) for value in values], type=pa.string())
+                json_columns.append(key)
+        # Keys that each row did not have, so that they are not confused with keys set to None
+        arrays[_LACKING_COLUMN] = pa.array([[key for key in columns if key not in row] for row in rows],
+                                           type=pa.list_(pa.string()))
+        table = pa.Table.from_pydict(arrays)
+        table = table.replace_schema_metadata({_JSON_COLUMNS_KEY: json.dumps(json_columns)})
+        os.makedirs(self.path, exist_ok=True)
+        pq.write_table(table, os.path.join(self.path, self._part_name()))
+
+    def _part_name(self) -> str:
+        """
+        Name of the next part file. Parts are numbered in the order they are written, so that when an entry
+        was stored more than once, loading them in order keeps the last one
+        """
+        if self._next_part is None:
+            existing = os.listdir(self.path) if os.path.isdir(self.path) else []
+            self._next_part = len(existing)
+        name = f'part-{self._next_part:08d}.parquet'
+        self._next_part += 1
+        return name
+
+
+# Column of the keys that each row of a Parquet part lacks
+_LACKING_COLUMN = '__lacking__'
+
+# Schema metadata key listing the columns of a Parquet part that are stored as json
+_JSON_COLUMNS_KEY = b'heatmapy.json_columns'
+
+
+def _json_columns(schema: 'pa.Schema') -> set:
+    """
+    Columns of a Parquet part that are stored as json
+    :param schema: the schema of the part
+    :return: the column names
+    """
+    metadata = schema.metadata or {}
+    return set(json.loads(metadata.get(_JSON_COLUMNS_KEY, b'[]')))
+
+
+# Available intermediate result formats, by name
+intermediate_stores = {
+    JsonlStore.extension: JsonlStore,
+    ParquetStore.extension: ParquetStore,
+}
+
+
+def _dump_json_line(data: dict) -> bytes:
+    """
+    Serialize one entry of a json lines file, using orjson if it is installed
+    :param data: the entry
+    :return: the encoded line, including the line break
+    """
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE)
+    return b'%s\n' % json.dumps(data).encode('utf-8')
+
+
+def _parse_jsonl(stream: BinaryIO):
+    """
+    Parse a json lines file (http://jsonlines.org/), using orjson if it is installed.
+    :param stream: binary file stream
+    :return: list of dicts
+    """
+    loads = orjson.loads if orjson is not None else json.loads
+    return [loads(line) for line in stream if line.strip()]
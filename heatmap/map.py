@@ -1,17 +1,27 @@
-import json
-import multiprocessing
-import os
+import asyncio
+import queue
 import threading
+from concurrent.futures import as_completed
 from concurrent.futures.thread import ThreadPoolExecutor
-from time import sleep
-from typing import List, Dict, Callable, TextIO, Optional, Union
+from typing import List, Dict, Callable, Optional, Union, Any, Tuple, Awaitable
 
+import numpy as np
 from geopy.distance import distance
 from shapely.geometry import shape, Polygon, MultiPolygon
+from shapely.ops import unary_union
+from shapely.strtree import STRtree
 
-from heatmap.common import Coord
+from heatmap.common import Coord, SHAPELY_2
+from heatmap.intermediate import intermediate_stores
 from heatmap.renderers.common import BaseRenderer
 
+# Number of units saved as intermediate results between flushes
+_FLUSH_EVERY = 500
+# Number of times to try getting the value of one unit before giving up on it
+_MAX_ATTEMPTS = 5
+# Bearing of the diagonal of each square from its origin corner, in degrees
+_SQUARE_BEARING = 35
+
 
 def _parse_geo_json(data: dict) -> List[Polygon]:
     """
@@ -22,26 +32,42 @@ def _parse_geo_json(data: dict) -> List[Polygon]:
     return [shape(f['geometry']) for f in data['features']]
 
 
-def _create_square(origin: Coord, side: float) -> Polygon:
+def _square_step(origin: Coord, side: float) -> Tuple[float, float]:
+    """
+    Return the offsets in degrees between the opposite corners of a square, for squares on the same row as origin.
+    The offsets only depend on the first coordinate of the origin, so one geodesic calculation serves a whole row.
+    :param origin: the origin of the first square of the row
+    :param side: the measurement of the diagonal of the square, in meters
+    :return: the latitude and longitude offsets
+    """
+    dest = distance(meters=side).destination(origin, _SQUARE_BEARING)
+    return dest[0] - origin[0], dest[1] - origin[1]
+
+
+def _create_square(origin: Coord, d_lat: float, d_lon: float) -> Polygon:
     """
-    Return a Polygon representing representing a square from an origin and the side
+    Return a Polygon representing representing a square from an origin and the offset to the opposite corner
     :param origin: the origin point
-    :param side: the measurement of one side of the square
+    :param d_lat: the latitude offset, as returned by _square_step
+    :param d_lon: the longitude offset, as returned by _square_step
     :return: A closed Polygon
     """
-    dest = distance(meters=side).destination(origin, 35)
-    coords = [origin, [dest[0], origin[1]], dest, [origin[0], dest[1]], origin]
-    # points = [[p.latitude, p.longitude] if isinstance(p, Point) else list(p) for p in coords]
+    lat, lon = origin
+    coords = [origin, (lat + d_lat, lon), (lat + d_lat, lon + d_lon), (lat, lon + d_lon), origin]
     return Polygon(coords)
 
 
-def _parse_jsonl(stream: TextIO):
+def _unbox(value: Any) -> Any:
     """
-    Parse a json lines file (http://jsonlines.org/).
-    :param stream: file stream
-    :return: list of dicts
+    Convert one numpy element from a batched result into a plain python value, with NaN meaning no value
+    :param value: the element
+    :return: a python value or None
     """
-    return [json.loads(line.strip()) for line in stream.readlines()]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
 
 
 class HeatMap(object):
@@ -52,7 +78,8 @@ class HeatMap(object):
                  load_intermediate_results=False,
                  save_intermediate_results=True,
                  filename=None,
-                 num_threads=1):
+                 num_threads=1,
+                 intermediate_format='jsonl'):
         """
         Creates a basic heatmap.
 
@@ -64,20 +91,26 @@ class HeatMap(object):
         :param save_intermediate_results: if set to true, will save intermediate data, to resume processing later
         :param filename: a file name (without extension) representing this heatmap
         :param num_threads: number of threads to use when extracting values
+        :param intermediate_format: how to save intermediate data, either 'jsonl' or 'parquet'
         """
         self.origin = origin
         self._boundaries: List[Polygon] = _parse_geo_json(geo_poly)
+        self._boundaries_tree = STRtree(self._boundaries)
         self.square_size = square_size
         self.squares: Dict[int, Polygon] = dict()
+        # Center of each square, as passed to the getters, indexed like self.squares
+        self._centers = np.empty((0, 2), dtype=np.float64)
         self._values = dict()
         self._bbox = None
         self.load_intermediate_results = load_intermediate_results
         self.save_intermediate_results = save_intermediate_results
         filename = filename or 'intermediate_result'
-        self.intermediate_file_name = f'{filename}.jsonl'
+        self._intermediate = intermediate_stores[intermediate_format](filename)
+        self.intermediate_file_name = self._intermediate.path
         self.map_file_name = f'{filename}.html'
-        manager = multiprocessing.Manager()
-        self._lock = manager.Lock()
+        self._lock = threading.Lock()
+        self._generating = False
+        self._unflushed = 0
         self.num_threads = num_threads
         self._missing = set()
         self.poly_region = []
@@ -105,9 +138,16 @@ class HeatMap(object):
             }
         with self._lock:
             self._values[idx] = data
-            if self.save_intermediate_results:
-                with open(self.intermediate_file_name, 'a') as fp:
-                    fp.write('%s\n' % json.dumps(data).strip())
+            if not self.save_intermediate_results:
+                return
+            self._intermediate.append(data)
+            if not self._generating:
+                self._intermediate.close()
+                return
+            self._unflushed += 1
+            if self._unflushed >= _FLUSH_EVERY:
+                self._intermediate.flush()
+                self._unflushed = 0
 
     @property
     def bounding_box(self):
@@ -137,6 +177,48 @@ class HeatMap(object):
         self._generate_units()
         self._get_values(getter)
 
+    def generate_batched(self, extractor: Any) -> None:
+        """
+        Generate the heatmap, retrieving the values of all units in a single call.
+        :param extractor: An object implementing 'get_values_batched(origin, points) -> dict', that receives the
+                          points as an array of shape (N, 2) and returns a dict of arrays of length N, NaN meaning
+                          no value. Extractors without it fall back to 'get_value(origin, pt)', one unit at a time.
+        """
+        get_values_batched = getattr(extractor, 'get_values_batched', None)
+        if get_values_batched is None:
+            self.generate(extractor.get_value)
+            return
+
+        self._generate_units()
+        self._load_values()
+        try:
+            missing = sorted(self._missing)
+            if not missing:
+                return
+            columns = get_values_batched(self.origin, self._centers[missing])
+            for row, idx in enumerate(missing):
+                self.set_value(idx, {key: _unbox(column[row]) for key, column in columns.items()})
+        finally:
+            self._close_intermediate_file()
+        self._missing = set()
+
+    async def generate_async(self, getter: Callable[[Coord, Coord], Awaitable[Union[dict, float]]]) -> None:
+        """
+        Generate the heatmap from a coroutine getter, for I/O bound getters. Up to num_threads calls to the getter
+        run concurrently on the event loop, instead of on as many threads.
+        :param getter: A coroutine function on the format 'async getter(origin, pt) -> float' that
+                       returns the heatmap value for two specific points.
+        """
+        self._generate_units()
+        self._load_values()
+        semaphore = asyncio.Semaphore(self.num_threads)
+        try:
+            await asyncio.gather(*(self._get_one_async(idx, getter, semaphore) for idx in sorted(self._missing)))
+        finally:
+            self._close_intermediate_file()
+        if self._missing:
+            print(f'Could not get the value of {len(self._missing)} units')
+
     def render(self, renderer: BaseRenderer, before_saving: Callable[[BaseRenderer, 'HeatMap'], None] = None) -> None:
         """
         Render the heatmap
@@ -150,40 +232,42 @@ class HeatMap(object):
             before_saving(renderer, self)
         renderer.save_to_file(self.map_file_name)
 
-    def normalize(self, custom_func: Callable[[float, float, float], float] = None):
+    def normalize(self, custom_func: Callable[[float, float, float], float] = None, vectorized: bool = False):
         """
-        Normalize the data into a 0..1 scale, keeping the original value on a new key called 'original_value'
+        Normalize the data into a 0..1 scale, keeping the original value on a new key called 'original_value'.
+        If all values are the same, they are all normalized to 0.
+        :param custom_func: An optional function on the format 'custom_func(value, min, max) -> float' to use
+                            instead of the linear scale.
+        :param vectorized: If set to true, custom_func is called only once, with a numpy array of all the values
         """
         print('Normalizing...')
-        min_val = None
-        max_val = None
+        items = [item for item in self._values.values() if item['value'] is not None]
+        if not items:
+            return
+        values = np.fromiter((item['value'] for item in items), dtype=np.float64, count=len(items))
+        min_val = float(values.min())
+        max_val = float(values.max())
 
-        for item in self._values.values():
-            if item['value'] is None:
-                continue
-            min_val = min(item['value'], min_val or item['value'])
-            max_val = max(item['value'], max_val or item['value'])
+        if not custom_func and max_val == min_val:
+            # All values are the same, there is no range to scale them into
+            normalized = [0.0] * len(items)
+        elif not custom_func:
+            normalized = ((values - min_val) / (max_val - min_val)).tolist()
+        elif vectorized:
+            normalized = np.asarray(custom_func(values, min_val, max_val), dtype=np.float64).tolist()
+        else:
+            normalized = [custom_func(value, min_val, max_val) for value in values.tolist()]
 
-        for key, item in self._values.items():
-            if item['value'] is None:
-                continue
-            self._values[key]['original_value'] = item['value']
-            if custom_func:
-                self._values[key]['value'] = custom_func(item['value'], min_val, max_val)
-            else:
-                self._values[key]['value'] = (item['value'] - min_val) / (max_val - min_val)
+        for item, value in zip(items, normalized):
+            item['original_value'] = item['value']
+            item['value'] = value
 
     def generate_polygon(self, selector: Callable[[dict], bool], **opts):
         print('Generating area polygon...')
-        poly_region = None
-        for item in self._values.values():
-            if selector(item):
-                if poly_region is None:
-                    poly_region = Polygon(item['poly'])
-                else:
-                    poly_region = poly_region.union(self.squares[item['idx']])
-
-        poly_region = list(poly_region) if isinstance(poly_region, MultiPolygon) else [poly_region]
+        selected = [self.squares[item['idx']] for item in self._values.values() if selector(item)]
+        poly_region = unary_union(selected)
+
+        poly_region = list(poly_region.geoms) if isinstance(poly_region, MultiPolygon) else [poly_region]
         self.poly_region = []
         for poly in poly_region:
             if not poly:
@@ -191,10 +275,8 @@ class HeatMap(object):
             poly = poly.buffer(0.005, resolution=2).buffer(-0.008, resolution=2).buffer(0.003, resolution=2)
 
             if isinstance(poly, MultiPolygon):
-                united_poly = poly[0]
-                for poly_part in poly[1:]:
-                    united_poly = united_poly.union(poly_part)
-                united_poly = list(united_poly) if isinstance(united_poly, MultiPolygon) else [united_poly]
+                united_poly = unary_union(list(poly.geoms))
+                united_poly = list(united_poly.geoms) if isinstance(united_poly, MultiPolygon) else [united_poly]
             else:
                 united_poly = [poly]
             self.poly_region.extend([p for p in united_poly if not p.is_empty])
@@ -207,63 +289,126 @@ class HeatMap(object):
         print('Generating units...')
         current_lat = self.bounding_box[0][0]
         idx = 0
+        centers = []
         while current_lat < self.bounding_box[1][0]:
             current_lon = self.bounding_box[0][1]
-            new_lat = current_lat
+            d_lat, d_lon = _square_step((current_lat, current_lon), self.square_size)
             while current_lon < self.bounding_box[1][1]:
-                rect = _create_square((current_lat, current_lon), self.square_size)
-                _, __, new_lat, current_lon = rect.bounds
-                if any(p.contains(rect) for p in self._boundaries):
+                rect = _create_square((current_lat, current_lon), d_lat, d_lon)
+                if any(p.contains(rect) for p in self._boundaries_near(rect)):
                     self.squares[idx] = rect
+                    # Getters receive the center with the axes swapped, as (y, x)
+                    centers.append((current_lon + d_lon / 2.0, current_lat + d_lat / 2.0))
                     idx += 1
-            current_lat = new_lat
+                current_lon += d_lon
+            current_lat += d_lat
+        self._centers = np.array(centers, dtype=np.float64).reshape(-1, 2)
 
-    def _get_values(self, getter: Callable[[Coord, Coord], Union[dict, float]]):
+    def _boundaries_near(self, geom: Polygon) -> List[Polygon]:
         """
-        Get the values for each individual unit
+        Return the boundary polygons whose bounding box intersects the one of a geometry
+        """
+        hits = self._boundaries_tree.query(geom)
+        if SHAPELY_2:
+            return [self._boundaries[h] for h in hits]
+        return hits
+
+    def _load_values(self):
         """
-        if self.load_intermediate_results and os.path.isfile(self.intermediate_file_name):
-            with open(self.intermediate_file_name, 'r') as fp:
-                self._values = {i['idx']: i for i in _parse_jsonl(fp)}
+        Load previous intermediate results, if any, and find out which units are still missing
+        """
+        if self.load_intermediate_results and self._intermediate.exists():
+            self._values = {i['idx']: i for i in self._intermediate.load()}
 
-        if self.save_intermediate_results and not os.path.isfile(
-                self.intermediate_file_name) or not self.load_intermediate_results:
-            open(self.intermediate_file_name, 'w').close()
+        if self.save_intermediate_results and not self._intermediate.exists() or not self.load_intermediate_results:
+            self._intermediate.reset()
 
         present = set(i['idx'] for i in self._values.values())
         self._missing = set(i for i in self.squares.keys() if i not in present)
 
-        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
-            while len(self._missing) > 0:
-                idx = self._missing.pop()
-                square = self.squares[idx]
-                coords_x, coords_y = square.exterior.coords.xy
-                cx = sum(coords_x[0:4]) / 4.0
-                cy = sum(coords_y[0:4]) / 4.0
-                args = ((cy, cx), idx, getter)
-                executor.submit(self._get_one, *args)
-
-    def _get_one(self, point: Coord, index: int, getter: Callable[[Coord, Coord], Union[dict, float]]):
+        self._generating = True
+        self._unflushed = 0
+
+    def _close_intermediate_file(self):
+        """
+        Persist the intermediate results buffered since _load_values
+        """
+        with self._lock:
+            self._generating = False
+            self._intermediate.close()
+
+    def _get_values(self, getter: Callable[[Coord, Coord], Union[dict, float]]):
         """
-        Get one single unit's value. Retries if not successful
+        Get the values for each individual unit
         """
+        self._load_values()
+        pending = queue.Queue()
+        for idx in sorted(self._missing):
+            pending.put((idx, 1))
         try:
-            if threading.current_thread().name.endswith('0_0'):
-                print(len(self._values), '/', len(self.squares.keys()))
-            value = None
-            for i in range(5):
-                try:
-                    value = getter(self.origin, point)
-                except (BaseException, Exception):
-                    value = False
-                if value is not False and value is not None:
-                    break
-                else:
-                    sleep(0.5)
-            if value is False:
-                self._missing.add(index)
-                sleep(5)
-            else:
-                self.set_value(index, value)
+            with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+                # Each worker drains the queue, so there are never more units in flight than threads
+                futures = [executor.submit(self._drain, pending, getter) for _ in range(self.num_threads)]
+                for future in as_completed(futures):
+                    future.result()
+        finally:
+            self._close_intermediate_file()
+        if self._missing:
+            print(f'Could not get the value of {len(self._missing)} units')
+
+    def _drain(self, pending: queue.Queue, getter: Callable[[Coord, Coord], Union[dict, float]]):
+        """
+        Get the values of pending units until there are none left
+        """
+        while True:
+            try:
+                index, attempt = pending.get_nowait()
+            except queue.Empty:
+                return
+            self._get_one(index, attempt, pending, getter)
+
+    def _get_one(self,
+                 index: int,
+                 attempt: int,
+                 pending: queue.Queue,
+                 getter: Callable[[Coord, Coord], Union[dict, float]]):
+        """
+        Get one single unit's value. If not successful, puts it back at the end of the queue to retry later
+        """
+        if threading.current_thread().name.endswith('0_0'):
+            print(len(self._values), '/', len(self.squares.keys()))
+        try:
+            value = getter(self.origin, tuple(self._centers[index].tolist()))
         except Exception as e:
-            print(e)
+            value = e
+        if value is None or isinstance(value, Exception):
+            if attempt < _MAX_ATTEMPTS:
+                pending.put((index, attempt + 1))
+                return
+            if isinstance(value, Exception):
+                print(f'Giving up on unit {index}: {value}')
+                return
+        self._missing.discard(index)
+        self.set_value(index, value)
+
+    async def _get_one_async(self,
+                             index: int,
+                             getter: Callable[[Coord, Coord], Awaitable[Union[dict, float]]],
+                             semaphore: asyncio.Semaphore):
+        """
+        Get one single unit's value from a coroutine getter. Retries if not successful
+        """
+        value = None
+        for _ in range(_MAX_ATTEMPTS):
+            async with semaphore:
+                try:
+                    value = await getter(self.origin, tuple(self._centers[index].tolist()))
+                except Exception as e:
+                    value = e
+            if value is not None and not isinstance(value, Exception):
+                break
+        if isinstance(value, Exception):
+            print(f'Giving up on unit {index}: {value}')
+            return
+        self._missing.discard(index)
+        self.set_value(index, value)
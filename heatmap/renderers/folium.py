@@ -1,17 +1,206 @@
-from typing import Callable, List
+import colorsys
+import hashlib
+import json
+import os
+from collections import defaultdict
+from functools import lru_cache
+from typing import Callable, List, Union, Optional
 
 import folium
-from shapely.geometry import Polygon
+import numpy as np
+import shapely
+from folium.utilities import camelize
+from shapely.geometry import Polygon, mapping
+from shapely.ops import unary_union
 
-from heatmap.common import Coord
-from heatmap.renderers.common import BaseRenderer
+from heatmap.common import Coord, SHAPELY_2
+from heatmap.renderers.common import BaseRenderer, _no_label
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
-def _default_color_scale(value: float) -> str:
-    """ A green-to-red color scale """
-    pct = 1 - max(0, min(1, value))
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# A sensible place to pass as the cache directory of FoliumRenderer
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'heatmapy')
+
+# Decimal places kept on rendered coordinates, about 11cm, which is plenty for any zoom level
+_COORD_DECIMALS = 6
+
+# Characters written to the output file at a time
+_WRITE_CHUNK = 1 << 20
+
+
+def _func_key(func: Callable) -> bytes:
+    """
+    Identify a function across runs, by its name and compiled code.
+    Changes to what it reads from outside (globals, closures) are not taken into account.
+    :param func: the function
+    :return: a key for the function
+    """
+    name = '%s.%s' % (getattr(func, '__module__', ''), getattr(func, '__qualname__', repr(func)))
+    code = getattr(func, '__code__', None)
+    if code is None:
+        return name.encode('utf-8')
+    return name.encode('utf-8') + code.co_code + repr(code.co_consts).encode('utf-8')
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _value_to_hue(values: np.ndarray) -> np.ndarray:
+        """ Hue in degrees of each value on the green-to-red scale, compiled """
+        out = np.empty_like(values)
+        for i in range(values.size):
+            x = values[i]
+            # NaN fails both comparisons and ends up as 1, like max(0, min(1, nan)) does
+            x = 0.0 if x < 0.0 else (x if x <= 1.0 else 1.0)
+            out[i] = 130.0 * (1.0 - x)
+        return out
+else:
+    def _value_to_hue(values: np.ndarray) -> np.ndarray:
+        """ Hue in degrees of each value on the green-to-red scale """
+        # A single array is allocated, the rest is done in-place on it
+        hues = np.clip(values, 0.0, 1.0)
+        # NaN is clamped to 1, like max(0, min(1, nan)) does
+        hues[np.isnan(hues)] = 1.0
+        np.subtract(1.0, hues, out=hues)
+        hues *= 130.0
+        return hues
+
+
+def _hues_to_hex(hues: np.ndarray) -> List[str]:
+    """
+    Convert hues in degrees into hex colors with 75% saturation and 50% lightness, like colorsys.hls_to_rgb does
+    :param hues: the hues
+    :return: a list of '#rrggbb' colors
+    """
+    lightness, saturation = 0.5, 0.75
+    amplitude = saturation * min(lightness, 1.0 - lightness)
+    k = (np.array([0.0, 8.0, 4.0]) + hues[:, None] / 30.0) % 12.0
+    rgb = lightness - amplitude * np.clip(np.minimum(k - 3.0, 9.0 - k), -1.0, 1.0)
+    return ['#%02x%02x%02x' % tuple(color) for color in np.rint(rgb * 255).astype(int).tolist()]
+
+
+def _default_color_scale(value: Union[float, np.ndarray]) -> Union[str, List[str]]:
+    """ A green-to-red color scale. Given an array of values, returns a list with the color of each """
+    if isinstance(value, np.ndarray):
+        return _hues_to_hex(_value_to_hue(value))
+    pct = 1.0 - (0.0 if value < 0.0 else value if value <= 1.0 else 1.0)
     hue = 130.0 * pct
-    return 'hsl(%.2f, 75%%, 50%%)' % hue
+    r, g, b = colorsys.hls_to_rgb(hue / 360.0, 0.5, 0.75)
+    return '#%02x%02x%02x' % (round(r * 255), round(g * 255), round(b * 255))
+
+
+def _dump_json(data, sort_keys: bool = False) -> bytes:
+    """
+    Serialize to json, using orjson if it is installed. Anything that is not serializable goes through str()
+    :param data: the data
+    :param sort_keys: whether to sort the keys of dicts, for a stable output
+    :return: the encoded json
+    """
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        return orjson.dumps(data, default=str, option=option)
+    return json.dumps(data, sort_keys=sort_keys, default=str).encode('utf-8')
+
+
+def _load_json(raw: bytes):
+    """
+    Parse json, using orjson if it is installed
+    :param raw: the encoded json
+    :return: the data
+    """
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _round_coords(coords) -> List[List[float]]:
+    """
+    Round coordinates to _COORD_DECIMALS, so that they are serialized with short representations.
+    :param coords: a sequence of points
+    :return: the rounded points, as lists
+    """
+    return np.round(np.asarray(coords, dtype=np.float64), _COORD_DECIMALS).tolist()
+
+
+def _unit_polys(units: List[dict]) -> List[List[List[float]]]:
+    """
+    Get the rounded coordinates of the heatmap units.
+    Grid squares all have the same number of points, so they are usually stacked and rounded all at once.
+    :param units: the heatmap units
+    :return: the coordinates of each unit
+    """
+    polys = [unit['poly'] for unit in units]
+    if len({len(poly) for poly in polys}) > 1:
+        return [_round_coords(poly) for poly in polys]
+    return _round_coords(polys)
+
+
+def _unit_features(polys: List[List[List[float]]], fills: List[str], labels: List[Optional[str]]) -> List[dict]:
+    """
+    Make one GeoJson feature per heatmap unit.
+    Units are stored with the same (x, y) axis order as GeoJson, so there is no need to swap them
+    :param polys: the coordinates of each unit
+    :param fills: the color of each unit
+    :param labels: the label of each unit
+    :return: a list of features
+    """
+    return [{
+        'type': 'Feature',
+        'geometry': {'type': 'Polygon', 'coordinates': [poly]},
+        'properties': {'fill': fill, 'popup': label},
+    } for poly, fill, label in zip(polys, fills, labels)]
+
+
+def _merged_features(polys: List[List[List[float]]], fills: List[str]) -> List[dict]:
+    """
+    Make one GeoJson feature per color, merging all the heatmap units of that color.
+    Adjacent units often share a color, so this produces a lot less shapes for the browser to draw
+    :param polys: the coordinates of each unit
+    :param fills: the color of each unit
+    :return: a list of features
+    """
+    by_fill = defaultdict(list)
+    for poly, fill in zip(polys, fills):
+        by_fill[fill].append(Polygon(poly))
+    return [{
+        'type': 'Feature',
+        'geometry': mapping(unary_union(shapes)),
+        'properties': {'fill': fill, 'popup': None},
+    } for fill, shapes in by_fill.items()]
+
+
+def _exterior_rings(polys: List[Polygon]) -> List[List[List[float]]]:
+    """
+    Get the exterior coordinates of many polygons, in the same (x, y) axis order as GeoJson.
+    On Shapely 2 they are extracted all at once.
+    :param polys: the polygons
+    :return: a list of coordinates per polygon
+    """
+    if not SHAPELY_2:
+        return [_round_coords(poly.exterior.coords) for poly in polys]
+    coords, index = shapely.get_coordinates(shapely.get_exterior_ring(polys), return_index=True)
+    coords = np.round(coords, _COORD_DECIMALS)
+    return [part.tolist() for part in np.split(coords, np.flatnonzero(np.diff(index)) + 1)]
+
+
+def _path_style(opts: dict) -> dict:
+    """
+    Convert folium.Polygon options into a Leaflet style for GeoJson paths.
+    Like folium.Polygon, paths are not filled unless asked to.
+    :param opts: the options
+    :return: the style
+    """
+    style = {camelize(key): value for key, value in opts.items()}
+    style.setdefault('fill', 'fillColor' in style)
+    return style
 
 
 class FoliumRenderer(BaseRenderer):
@@ -22,6 +211,8 @@ class FoliumRenderer(BaseRenderer):
                  tiles: str = 'Stamen Toner',
                  opacity: float = 0.75,
                  *args,
+                 vectorized_color_scale: Optional[bool] = None,
+                 cache_dir: Optional[str] = None,
                  **kwargs):
         """
         Renders the heatmap into an static HTML interactive map
@@ -30,16 +221,26 @@ class FoliumRenderer(BaseRenderer):
         :param center: coordinates of the center of the map
         :param tiles: the name of the map texture used
         :param opacity: opacity of the heatmap
+        :param vectorized_color_scale: whether the color scale can be called once with an array of all the values,
+                                       returning a list of colors. Defaults to true only for the default scale
+        :param cache_dir: if given, the heatmap layer is cached on this directory (e.g. DEFAULT_CACHE_DIR), and
+                          rendering the same data with the same color scale and label functions reuses it
         """
         super().__init__(color_scale, *args, **kwargs)
+        if vectorized_color_scale is None:
+            vectorized_color_scale = color_scale is _default_color_scale
+        self.vectorized_color_scale = vectorized_color_scale
+        # Heatmaps tend to repeat a handful of values, so scalar color scales are only called once for each
+        self._cached_color_scale = lru_cache(maxsize=4096)(color_scale)
+        self._has_label = self.label_func is not None and self.label_func is not _no_label
         self._map = None
         self.zoom = zoom
         self.center = center
         self.tiles = tiles
         self.opacity = opacity
-        self._layers = {
-            'heatmap': folium.FeatureGroup(name='Heat map'),
-        }
+        self._heatmap_base_style = {}
+        self.cache_dir = cache_dir
+        self._layers = {}
 
     def render(self, data: List[dict], poly_region: List[Polygon], poly_opts: dict) -> None:
         """
@@ -54,28 +255,109 @@ class FoliumRenderer(BaseRenderer):
             zoom_start=self.zoom,
             tiles=self.tiles
         )
-        for unit in data:
-            value = unit['value']
-            if value is None:
-                continue
-            label = self.label_func(unit)
-            fill = self.color_scale_func(value)
-            folium.Polygon(
-                locations=[(y, x) for x, y in unit['poly']],
-                popup=label,
-                weight=0,
-                fill=value is not None,
-                fill_color=fill,
-                fill_opacity=self.opacity,
+        # Layers are rebuilt on every render, so that rendering again does not pile up the previous ones
+        self._layers = {
+            'heatmap': folium.FeatureGroup(name='Heat map'),
+        }
+        # Style options shared by all units, only the fill color changes from one to another
+        self._heatmap_base_style = {'weight': 0, 'fill': True, 'fillOpacity': self.opacity}
+        features = self._cached_heatmap_features(data)
+        has_popup = any(feature['properties']['popup'] is not None for feature in features)
+        if features:
+            folium.GeoJson(
+                {'type': 'FeatureCollection', 'features': features},
+                style_function=self._heatmap_style,
+                popup=folium.GeoJsonPopup(fields=['popup'], labels=False) if has_popup else None,
             ).add_to(self._layers['heatmap'])
         self._layers['heatmap'].add_to(self._map)
         if poly_region:
             self._render_poly_region(poly_region, poly_opts)
         folium.LayerControl(collapsed=False).add_to(self._map)
 
+    def _heatmap_features(self, data: List[dict]) -> List[dict]:
+        """
+        Make the GeoJson features of the heatmap.
+        The whole heatmap goes on a single GeoJson layer, instead of one folium.Polygon per unit.
+        :param data: the heatmap data
+        :return: a list of features
+        """
+        has_value = np.fromiter((unit['value'] is not None for unit in data), dtype=bool, count=len(data))
+        units = [data[idx] for idx in np.flatnonzero(has_value)]
+        values = np.fromiter((unit['value'] for unit in units), dtype=np.float64, count=len(units))
+        polys = _unit_polys(units)
+        fills = self._colors(values)
+        if self._has_label:
+            labels = [self.label_func(unit) for unit in units]
+            if any(label is not None for label in labels):
+                return _unit_features(polys, fills, labels)
+        # Without labels to tell units apart, units of the same color are merged into a single shape
+        return _merged_features(polys, fills)
+
+    def _cached_heatmap_features(self, data: List[dict]) -> List[dict]:
+        """
+        Same as _heatmap_features, but cached on disk if there is a cache directory
+        :param data: the heatmap data
+        :return: a list of features
+        """
+        if not self.cache_dir:
+            return self._heatmap_features(data)
+        digest = hashlib.blake2b(_dump_json(data, sort_keys=True))
+        digest.update(_func_key(self.color_scale_func))
+        digest.update(_func_key(self.label_func))
+        cache_file = os.path.join(self.cache_dir, '%s.json' % digest.hexdigest())
+        if os.path.isfile(cache_file):
+            with open(cache_file, 'rb') as fp:
+                return _load_json(fp.read())
+
+        features = self._heatmap_features(data)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(cache_file, 'wb') as fp:
+            fp.write(_dump_json(features))
+        return features
+
+    def _heatmap_style(self, feature: dict) -> dict:
+        """
+        Leaflet style of one unit of the heatmap
+        :param feature: the GeoJson feature of the unit
+        :return: the style options
+        """
+        return {**self._heatmap_base_style, 'fillColor': feature['properties']['fill']}
+
+    def _colors(self, values: np.ndarray) -> List[str]:
+        """
+        Get the color of each value, in a single call to the color scale if it is vectorized.
+        Color scales must be pure functions of the value
+        :param values: the values
+        :return: a list of colors
+        """
+        if self.vectorized_color_scale:
+            return list(self.color_scale_func(values))
+        return [self._cached_color_scale(value) for value in values.tolist()]
+
     def _render_poly_region(self, poly_region: List[Polygon], poly_opts: dict):
-        for poly in poly_region:
-            self.add_polygon(poly, **poly_opts)
+        """
+        Render the polygonal regions on a single GeoJson layer, with the same options add_polygon takes
+        :param poly_region: the polygonal regions
+        :param poly_opts: poly region options
+        """
+        opts = dict(poly_opts)
+        label = opts.pop('label', None)
+        layer_name = opts.pop('layer_name', 'heatmap')
+        if layer_name not in self._layers:
+            self._layers[layer_name] = folium.FeatureGroup(name=layer_name)
+            self._layers[layer_name].add_to(self._map)
+
+        features = [{
+            'type': 'Feature',
+            'geometry': {'type': 'Polygon', 'coordinates': [ring]},
+            'properties': {'popup': label},
+        } for ring in _exterior_rings(poly_region)]
+        style = _path_style(opts)
+        folium.GeoJson(
+            {'type': 'FeatureCollection', 'features': features},
+            style_function=lambda _: style,
+            popup=folium.GeoJsonPopup(fields=['popup'], labels=False) if label is not None else None,
+        ).add_to(self._layers[layer_name])
 
     def save_to_file(self, filename: str) -> None:
         """
@@ -85,7 +367,11 @@ class FoliumRenderer(BaseRenderer):
         """
         if self._map is None:
             raise ValueError('Not rendered')
-        self._map.save(filename)
+        html = self._map.get_root().render()
+        # Written in slices, so that only one slice at a time is encoded to bytes instead of the whole page
+        with open(filename, 'w', encoding='utf-8', buffering=_WRITE_CHUNK) as fp:
+            for start in range(0, len(html), _WRITE_CHUNK):
+                fp.write(html[start:start + _WRITE_CHUNK])
 
     def add_marker(self, point: Coord, label: str = None, layer_name: str = 'heatmap') -> None:
         """
@@ -133,5 +419,8 @@ class FoliumRenderer(BaseRenderer):
         if layer_name not in self._layers:
             self._layers[layer_name] = folium.FeatureGroup(name=layer_name)
             self._layers[layer_name].add_to(self._map)
-        coords = [[pt[1], pt[0]] for pt in list(poly.exterior.coords)]
+        if SHAPELY_2:
+            coords = _round_coords(shapely.get_coordinates(poly.exterior)[:, ::-1])
+        else:
+            coords = [[pt[1], pt[0]] for pt in _round_coords(poly.exterior.coords)]
         folium.Polygon(coords, popup=label, **opts).add_to(self._layers[layer_name])
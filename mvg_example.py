@@ -1,6 +1,7 @@
 import json
 from datetime import datetime
-from math import log2
+
+import numpy as np
 
 from heatmap import HeatMap, DefaultRenderer
 from heatmap.extractors import MVGExtractor
@@ -8,21 +9,28 @@ from heatmap.extractors import MVGExtractor
 home = (48.128446, 11.650027)
 mvg_key = 'YOUR MVG KEY'  # Replace with your own key
 
-mvg = MVGExtractor(mvg_key)
+# Requests are I/O bound, so the heatmap calls calc_time from this many threads at once (on a ThreadPoolExecutor).
+# The extractor's connection pool is sized to match.
+num_threads = 16
+
+mvg = MVGExtractor(mvg_key, num_threads=num_threads, cache_name='mvg_cache')
 
+_POPUP_TMPL = '<div style="font-size: 20px; width: 120px;text-align: center;">%d min</div>'
 
-def color(value: float) -> str:
-    """ A blue-to-red color scale """
-    pct = 1 - max(0, min(1, value))
-    hue = 210.0 * pct
-    return 'hsl(%.2f, 75%%, 50%%)' % hue
+
+def color(values: np.ndarray) -> list:
+    """ A blue-to-red color scale, for all values at once """
+    hues = 210.0 * (1.0 - np.clip(values, 0.0, 1.0))
+    return ['hsl(%.2f, 75%%, 50%%)' % hue for hue in hues.tolist()]
 
 
 def label(unit):
     """ Show travel time on the label """
-    time = int(unit.get("time"))
-    return f'<div style="font-size: 20px; width: 120px;text-align: center;">{time} min</div>'
+    return _POPUP_TMPL % int(unit['time'])
+
 
+# A single reference time for all requests, so that every unit is measured at the same time of day
+now = datetime.now()
 
 with open('./geo/muenchen.json', 'r') as fp:
     geo_json = json.load(fp)
@@ -30,7 +38,7 @@ with open('./geo/muenchen.json', 'r') as fp:
 
 def calc_time(pt1, pt2):
     """ Calculate the time to get somewhere by UBahn """
-    t_ubahn = mvg.average_time_between(pt1, pt2, datetime.now())
+    t_ubahn = mvg.average_time_between(pt1, pt2, now)
     if not t_ubahn:
         return None
     value = int(t_ubahn / 60.0)
@@ -38,11 +46,12 @@ def calc_time(pt1, pt2):
     return {'value': value, 'time': value}
 
 
-renderer = DefaultRenderer(center=home, zoom=12, color_scale=color, label=label)
-h_map = HeatMap(home, geo_json, square_size=250, filename='mvg', load_intermediate_results=True)
+renderer = DefaultRenderer(center=home, zoom=12, color_scale=color, label=label, vectorized_color_scale=True)
+h_map = HeatMap(home, geo_json, square_size=250, filename='mvg', load_intermediate_results=True,
+                num_threads=num_threads)
 h_map.generate(calc_time)
 # Normalize on a log2 scale
-h_map.normalize(lambda v, _1, _2: log2(v))
+h_map.normalize(lambda v, _1, _2: np.log2(v), vectorized=True)
 # Then again on a 0 to 1 range
 h_map.normalize()
 h_map.render(renderer)